@@ -1,34 +1,55 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-import json
 import os
 from os.path import abspath, dirname, join, exists
 import sys
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 HERE = dirname(abspath(__file__))
 SRC = join(HERE, "..")
 DATA = join(SRC, "data")
+MOVEMENT_RPC_URL = "https://movement.uber.com/_rpc"
+MOVEMENT_RPC_PARAMS = (("rpc", "GET_DETAILED_TRAVEL_TIMES"),)
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:69.0) Gecko/20100101 Firefox/69.0"
+_DELTA = timedelta(seconds=19800)
+DEFAULT_TIME_RANGE = (
+    int((datetime(2018, 10, 1) + _DELTA).strftime("%s")),
+    int((datetime(2018, 12, 31) + _DELTA).strftime("%s")),
+)
+_SESSION = None
 
 sys.path.insert(0, SRC)
-from utils import get_bmtc_routes, route_to_wards, get_wards
+from utils import (
+    atomic_write,
+    dump_ward_lookup_cache,
+    get_bmtc_routes,
+    get_wards,
+    json_dumps,
+    json_loads,
+    route_to_wards,
+)
 
 
 def dump_ward_pairs(include_reverse=True):
-    """Get list of all ward pairs between which we want transit time.
+    """Dump list of all ward pairs between which we want transit time.
 
     If include_reverse is True, the reverse ward pairs are also added to the
     list of ward pairs. This is useful for computing the "up" and "down"
     transit time for a route.
 
+    The pairs are written to the dump file as they are generated. Returns the
+    number of pairs written, or None if the pairs have already been dumped.
+
     """
 
     dump_path = join(DATA, "ward-pairs.json")
     if exists(dump_path):
-        with open(dump_path) as f:
-            return json.load(f)
+        return None
 
     data = get_bmtc_routes()
     print("Dumping pairs of wards for {} bus routes ".format(len(data)))
@@ -39,30 +60,77 @@ def dump_ward_pairs(include_reverse=True):
     }
 
     ward_pairs = set()
-    for row in data.index:
-        route = data.loc[row]
-        try:
-            w = route_to_wards(route)
-            pairs = zip(w[:-1], w[1:])
-            ward_pairs.update(pairs)
-        except TypeError:
-            pass
-
-    movement_pairs = []
-    for (src_id, _), (dst_id, _) in ward_pairs:
-        if src_id is None or dst_id is None:
-            continue
-        src_movement_id = ward_properties[src_id]["MOVEMENT_ID"]
-        dst_movement_id = ward_properties[dst_id]["MOVEMENT_ID"]
-        pair = ((src_id, src_movement_id), (dst_id, dst_movement_id))
-        movement_pairs.append(pair)
-        if include_reverse:
-            movement_pairs.append(pair[::-1])
-
-    with open(dump_path, "w") as f:
-        json.dump(movement_pairs, f, indent=2)
-
-    return movement_pairs
+    for bus_stops in data.loc[data["bus_stops"].notna(), "bus_stops"]:
+        # Only the ward ids are needed to identify a pair
+        ids = [ward_id for ward_id, _ in route_to_wards(bus_stops)]
+        pairs = zip(ids[:-1], ids[1:])
+        ward_pairs.update(pairs)
+    dump_ward_lookup_cache()
+
+    def movement_pairs():
+        for src_id, dst_id in ward_pairs:
+            if src_id is None or dst_id is None:
+                continue
+            src_movement_id = ward_properties[src_id]["MOVEMENT_ID"]
+            dst_movement_id = ward_properties[dst_id]["MOVEMENT_ID"]
+            pair = ((src_id, src_movement_id), (dst_id, dst_movement_id))
+            yield pair
+            if include_reverse:
+                yield pair[::-1]
+
+    # Write to a temporary file, and move it into place only when complete,
+    # so that a failure doesn't leave behind a truncated dump
+    count = 0
+    with atomic_write(dump_path) as f:
+        f.write("[")
+        for pair in movement_pairs():
+            f.write(",\n  " if count else "\n  ")
+            f.write(json_dumps(pair))
+            count += 1
+        f.write("\n]\n")
+
+    return count
+
+
+def read_ward_pairs():
+    """Read the list of ward pairs, dumping them first if required."""
+    dump_ward_pairs()
+    with open(join(DATA, "ward-pairs.json"), "rb") as f:
+        return json_loads(f.read())
+
+
+def get_session(pool_size=32):
+    """Return the session used for all requests to Uber's backend.
+
+    The session is created on the first call, and reuses connections across
+    requests. Requests are retried when Uber rate limits us, or has server
+    errors.
+
+    """
+    global _SESSION
+    if _SESSION is not None:
+        return _SESSION
+
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
+            "User-Agent": USER_AGENT,
+            "x-csrf-token": os.environ["MOVEMENT_CSRF_TOKEN"],
+        }
+    )
+    session.cookies.set("web-movement:sess", os.environ["MOVEMENT_WEB_COOKIE"])
+    _SESSION = session
+    return _SESSION
 
 
 def get_travel_time(
@@ -84,20 +152,7 @@ def get_travel_time(
     if days_of_week is None:
         days_of_week = [1, 2, 3, 4, 5, 6, 7]
 
-    if time_range:
-        start, end = time_range
-    else:
-        delta = timedelta(seconds=19800)
-        start = int((datetime(2018, 10, 1) + delta).strftime("%s"))
-        end = int((datetime(2018, 12, 31) + delta).strftime("%s"))
-
-    cookies = {"web-movement:sess": os.environ["MOVEMENT_WEB_COOKIE"]}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:69.0) Gecko/20100101 Firefox/69.0",
-        "x-csrf-token": os.environ["MOVEMENT_CSRF_TOKEN"],
-        "Content-Type": "application/json",
-    }
-    params = (("rpc", "GET_DETAILED_TRAVEL_TIMES"),)
+    start, end = time_range if time_range else DEFAULT_TIME_RANGE
     data = {
         "query": {
             "cityId": 130,
@@ -110,31 +165,105 @@ def get_travel_time(
         }
     }
 
-    response = requests.post(
-        "https://movement.uber.com/_rpc",
-        headers=headers,
-        params=params,
-        cookies=cookies,
-        data=json.dumps(data),
+    response = get_session().post(
+        MOVEMENT_RPC_URL, params=MOVEMENT_RPC_PARAMS, json=data
     )
     assert response.status_code == 200
-    assert response.json()["status"] == "success"
-    return response.json()["data"]
+    result = response.json()
+    assert result["status"] == "success"
+    return result["data"]
 
 
-def download_uber_travel_time_data():
-    pairs = dump_ward_pairs()
-    print("Fetching travel time for {} pairs".format(len(pairs)))
-
+def read_travel_time_checkpoint(path):
+    """Read travel times already fetched and saved to a JSON-lines file."""
     travel_time_data = dict()
-    for i, ((src_w_id, src_m_id), (dst_w_id, dst_m_id)) in enumerate(pairs):
-        travel_time = get_travel_time(src_m_id, dst_m_id)
-        print(i, (src_w_id, dst_w_id))
-        travel_time_data["{}-{}".format(src_w_id, dst_w_id)] = travel_time
+    if not exists(path):
+        return travel_time_data
+
+    with open(path) as f:
+        for line in f:
+            # Ignore a partially written last line, from a crashed run
+            try:
+                travel_time_data.update(json_loads(line))
+            except ValueError:
+                continue
+    return travel_time_data
+
+
+def terminate_partial_line(path):
+    """Terminate a partially written last line, from a crashed run.
+
+    Without this, the first record appended on a resumed run would be
+    written onto the end of the partial line, and be lost. The partial line
+    itself is left in place, and ignored when reading the checkpoint.
+
+    """
+    if not exists(path):
+        return
 
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def compact_jsonl_to_json():
+    """Write the checkpointed travel times into a single JSON file."""
+    travel_time_data = read_travel_time_checkpoint(
+        join(DATA, "uber-travel-time-data.jsonl")
+    )
     path = join(DATA, "uber-travel-time-data.json")
-    with open(path, "w") as f:
-        json.dump(travel_time_data, f, indent=2)
+    with atomic_write(path) as f:
+        f.write(json_dumps(travel_time_data, indent=True))
+
+
+def download_uber_travel_time_data(max_workers=20):
+    pairs = read_ward_pairs()
+    checkpoint_path = join(DATA, "uber-travel-time-data.jsonl")
+    fetched = set(read_travel_time_checkpoint(checkpoint_path))
+    terminate_partial_line(checkpoint_path)
+    pairs = [
+        pair
+        for pair in pairs
+        if "{}-{}".format(pair[0][0], pair[1][0]) not in fetched
+    ]
+    print("Fetching travel time for {} pairs".format(len(pairs)))
+
+    # Create the session before any of the worker threads need it
+    get_session()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    failed = []
+    try:
+        with open(checkpoint_path, "a") as f:
+            futures = {}
+            for (src_w_id, src_m_id), (dst_w_id, dst_m_id) in pairs:
+                future = executor.submit(get_travel_time, src_m_id, dst_m_id)
+                futures[future] = (src_w_id, dst_w_id)
+            for i, future in enumerate(as_completed(futures)):
+                src_w_id, dst_w_id = futures[future]
+                # Keep checkpointing the other pairs, if fetching one fails
+                try:
+                    travel_time = future.result()
+                except Exception as e:
+                    print(i, (src_w_id, dst_w_id), "failed:", repr(e))
+                    failed.append((src_w_id, dst_w_id))
+                    continue
+                print(i, (src_w_id, dst_w_id))
+                key = "{}-{}".format(src_w_id, dst_w_id)
+                f.write(json_dumps({key: travel_time}) + "\n")
+                f.flush()
+    finally:
+        # Don't run the queued requests, if we stop early (Ctrl-C, etc.),
+        # since their results can't be checkpointed anymore
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if failed:
+        print("Failed to fetch travel time for {} pairs.".format(len(failed)))
+        print("Re-run the script to retry fetching them.")
+    compact_jsonl_to_json()
 
 
 if __name__ == "__main__":
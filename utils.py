@@ -1,98 +1,408 @@
+from contextlib import contextmanager
+import functools
 import json
-from os.path import abspath, dirname, join
+import os
+import pickle
+import tempfile
+from os.path import abspath, dirname, exists, getmtime, join, splitext
 
+import numpy as np
 import pandas as pd
-from shapely.geometry import shape, Point
+import shapely
+from shapely.strtree import STRtree
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 HERE = dirname(abspath(__file__))
 DATA = join(HERE, "data")
-WARD_SHAPES = []
+WARD_LOOKUP_CACHE = None
+# Bump this when the ward shapes returned by get_ward_shapes change
+WARD_SHAPES_PICKLE_VERSION = 3
 UBER_TRAVEL_TIMES = None
+UBER_MEAN_TIMES = None
+
+
+def json_loads(data):
+    """Parse JSON using orjson, if it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False):
+    """Serialize to a JSON string using orjson, if it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, option=option).decode()
+    return json.dumps(obj, indent=2 if indent else None)
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """Open a temporary file for writing, and move it to path when done.
+
+    If writing fails, the temporary file is removed and path is left as it
+    was, instead of being left with partially written data.
+
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        # mkstemp creates the file readable only by the owner; use the
+        # permissions a file created with open would get, instead.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def get_bmtc_routes(source="routes.2018.csv"):
     # Read the BMTC Route data
-    return pd.read_csv(join(DATA, source))
+    routes = read_routes(join(DATA, source))
+    # Parse the bus-stops JSON once, instead of for each use of a route
+    routes["bus_stops"] = routes["map_json_content"].map(parse_bus_stops)
+    return routes
+
+
+def read_routes(csv_path):
+    """Read routes from the CSV, or a Parquet copy of it, if up-to-date.
+
+    The Parquet copy is written the first time the CSV is read, and requires
+    pyarrow to be installed. The CSV is read whenever the Parquet copy can't
+    be used.
+
+    """
+    parquet_path = splitext(csv_path)[0] + ".parquet"
+    if exists(parquet_path) and getmtime(parquet_path) >= getmtime(csv_path):
+        # Fall back to the CSV, if the Parquet copy can't be read for any
+        # reason (pyarrow isn't installed, the file is corrupt, etc.)
+        try:
+            return pd.read_parquet(parquet_path, engine="pyarrow")
+        except Exception:
+            pass
+
+    routes = pd.read_csv(csv_path)
+    # The Parquet copy is only a cache, and failing to write it is fine
+    try:
+        with atomic_write(parquet_path, "wb") as f:
+            routes.to_parquet(f, engine="pyarrow")
+    except Exception:
+        pass
+    return routes
+
+
+def parse_bus_stops(map_json_content):
+    if not isinstance(map_json_content, (str, bytes)):
+        return None
+    return json_loads(map_json_content)
 
 
 def get_wards():
     # Read the ward boundaries data from Uber
-    with open(join(DATA, "bangalore_wards.json")) as f:
-        wards = json.load(f)
+    with open(join(DATA, "bangalore_wards.json"), "rb") as f:
+        wards = json_loads(f.read())
 
     return wards
 
 
-def get_ward_shapes():
-    wards = get_wards()
-    ward_shapes = [
-        (
-            shape(feature["geometry"]),
-            int(feature["properties"]["WARD_NO"]),
-            feature["properties"]["WARD_NAME"],
-        )
-        for feature in wards["features"]
+def get_ward_frame():
+    # NOTE: pyogrio (and geopandas) are only needed to build the ward shapes
+    import pyogrio
+
+    # Read the ward boundaries data from Uber, as a GeoDataFrame
+    return pyogrio.read_dataframe(join(DATA, "bangalore_wards.json"))
+
+
+def get_ward_shapes(ward_frame):
+    """Return the ward geometries, ids, names and edges as parallel arrays.
+
+    The edges of all the wards are concatenated into a single (4, N) array,
+    and the edges of the i-th ward are edges[:, offsets[i]:offsets[i + 1]].
+
+    """
+    geometries = np.array(ward_frame.geometry.to_list(), dtype=object)
+    ward_ids = ward_frame["WARD_NO"].to_numpy(dtype=np.int32)
+    ward_names = ward_frame["WARD_NAME"].to_numpy(dtype=object)
+    edges = [get_edges(geometry) for geometry in geometries]
+    edge_offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    edge_offsets[1:] = np.cumsum([e.shape[1] for e in edges])
+    ward_edges = np.ascontiguousarray(np.hstack(edges), dtype=np.float64)
+    return geometries, ward_ids, ward_names, ward_edges, edge_offsets
+
+
+def get_edges(geometry):
+    """Return all the edges of a (multi-)polygon as a (4, N) array.
+
+    The rows are the x1, y1, x2, y2 co-ordinates of the edges, including the
+    edges of the holes in the polygon.
+
+    """
+    rings = shapely.get_rings(shapely.get_parts(geometry))
+    edges = []
+    for ring in rings:
+        coords = shapely.get_coordinates(ring)
+        edges.append(np.hstack([coords[:-1], coords[1:]]))
+    return np.vstack(edges).T
+
+
+def _contains_xy(edges, offsets, ward_idx, xs, ys):
+    """Check if the wards contain the points, using ray-casting.
+
+    Checks if the ward ward_idx[k] contains the point (xs[k], ys[k]), using
+    the crossing number (even-odd) rule, which also handles holes and
+    multi-polygons. Returns the (inside, uncertain) boolean arrays.
+
+    Points on the boundary of a ward are not contained in it, like with
+    shapely.contains_xy. Since floating point errors can't be ruled out for
+    points on or very close to an edge, such checks are marked as uncertain,
+    and need to be done exactly.
+
+    """
+    n = len(ward_idx)
+    inside = np.zeros(n, dtype=np.bool_)
+    uncertain = np.zeros(n, dtype=np.bool_)
+    for k in range(n):
+        w, px, py = ward_idx[k], xs[k], ys[k]
+        crossings = False
+        for i in range(offsets[w], offsets[w + 1]):
+            x1, y1, x2, y2 = edges[0, i], edges[1, i], edges[2, i], edges[3, i]
+            if py < min(y1, y2) or py > max(y1, y2):
+                continue
+            # Orientation of the point, with respect to the edge
+            left = (x2 - x1) * (py - y1)
+            right = (y2 - y1) * (px - x1)
+            det = left - right
+            if abs(det) <= 1e-15 * (abs(left) + abs(right)):
+                uncertain[k] = True
+                break
+            # The ray from the point, towards +x, crosses the edge
+            if (y1 > py) != (y2 > py) and (det > 0) == (y2 > y1):
+                crossings = not crossings
+        inside[k] = crossings and not uncertain[k]
+    return inside, uncertain
+
+
+# NOTE: The ray-casting check is only used when numba is installed, since
+# the pure Python version is slower than shapely.
+contains_xy = njit(cache=True)(_contains_xy) if njit is not None else None
+
+
+def read_ward_lookup_cache():
+    """Read the cache of ward lookups persisted by earlier runs.
+
+    The cache is discarded if the ward boundaries data has changed since it
+    was persisted.
+
+    """
+    global WARD_LOOKUP_CACHE
+    if WARD_LOOKUP_CACHE is None:
+        path = join(DATA, "ward-lookup-cache.json")
+        lookups = []
+        if exists(path):
+            # A cache that can't be read is treated like a missing one
+            try:
+                with open(path, "rb") as f:
+                    cached = json_loads(f.read())
+                wards_mtime = getmtime(join(DATA, "bangalore_wards.json"))
+                if cached["wards_mtime"] == wards_mtime:
+                    lookups = cached["lookups"]
+            except (ValueError, TypeError, KeyError):
+                lookups = []
+        try:
+            WARD_LOOKUP_CACHE = {
+                (lat, lng): (ward_id, ward_name)
+                for lat, lng, ward_id, ward_name in lookups
+            }
+        except (ValueError, TypeError):
+            WARD_LOOKUP_CACHE = {}
+
+    return WARD_LOOKUP_CACHE
+
+
+def dump_ward_lookup_cache():
+    """Persist the cache of ward lookups, to be reused across runs."""
+    cache = read_ward_lookup_cache()
+    lookups = [
+        (lat, lng, ward_id, ward_name)
+        for (lat, lng), (ward_id, ward_name) in cache.items()
     ]
-    return ward_shapes
+    cached = {
+        "wards_mtime": getmtime(join(DATA, "bangalore_wards.json")),
+        "lookups": lookups,
+    }
+    path = join(DATA, "ward-lookup-cache.json")
+    with atomic_write(path) as f:
+        f.write(json_dumps(cached))
 
 
 def get_ward(lat_lng):
     """Return ward that contains a given point (lat, lng).   """
 
-    global WARD_SHAPES
-    if not WARD_SHAPES:
-        WARD_SHAPES = get_ward_shapes()
+    return get_wards_for_points([lat_lng])[0]
 
-    # NOTE: The WARD_SHAPES are in (lng, lat).
-    # So, we swap co-ordinates on the point.
-    p = Point([float(x) for x in lat_lng][::-1])
-    for ward_shape, ward_id, ward_name in WARD_SHAPES:
-        if ward_shape.contains(p):
-            return ward_id, ward_name
 
-    return (None, None)
+def _load_or_build_ward_shapes():
+    """Load the ward shapes and tree from a pickle, or build and pickle them.
+
+    The pickle is rebuilt whenever the ward boundaries data is newer, or the
+    pickle was written with a different format.
+
+    """
+    wards_path = join(DATA, "bangalore_wards.json")
+    pickle_path = join(DATA, "ward_shapes.pkl")
+    ward_shapes = None
+    if exists(pickle_path) and getmtime(pickle_path) >= getmtime(wards_path):
+        try:
+            with open(pickle_path, "rb") as f:
+                version, ward_shapes, ward_tree = pickle.load(f)
+        except Exception:
+            version = None
+        if version != WARD_SHAPES_PICKLE_VERSION:
+            ward_shapes = None
+
+    if ward_shapes is None:
+        ward_shapes = get_ward_shapes(get_ward_frame())
+        # The STRtree is used for bbox pre-filtering of the wards
+        ward_tree = STRtree(ward_shapes[0])
+        payload = (WARD_SHAPES_PICKLE_VERSION, ward_shapes, ward_tree)
+        with atomic_write(pickle_path, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Prepared geometries are not pickled, and need to be prepared again
+    shapely.prepare(ward_shapes[0])
+    return ward_shapes, ward_tree
+
+
+@functools.cache
+def _ward_index():
+    """Return the ward shapes, tree and bounds, loading them on first use."""
+    ward_shapes, ward_tree = _load_or_build_ward_shapes()
+    # Bounding box of all the wards, as (min_lng, min_lat, max_lng, max_lat)
+    ward_bounds = tuple(shapely.total_bounds(ward_shapes[0]).tolist())
+    return ward_shapes, ward_tree, ward_bounds
+
+
+def in_ward_bounds(lat, lng):
+    """Check if a point (lat, lng) is inside the bounding box of all wards.
+
+    Bus-stops with garbage co-ordinates (zeros, outside the city, or lat and
+    lng swapped) are outside the bounding box, and can't be in any ward.
+
+    """
+    _, _, (min_lng, min_lat, max_lng, max_lat) = _ward_index()
+    return (min_lat <= lat) & (lat <= max_lat) & (min_lng <= lng) & (lng <= max_lng)
+
+
+def get_wards_for_points(lat_lngs):
+    """Return wards that contain each of the given points (lat, lng).
+
+    All the points that are not already in the lookup cache are queried
+    against the ward tree in a single call, and the candidate wards are
+    checked using ray-casting (if numba is installed) or the prepared ward
+    geometries.
+
+    """
+    coords = np.array(lat_lngs, dtype=float).reshape(-1, 2)
+    cache = read_ward_lookup_cache()
+    keys = [(lat, lng) for lat, lng in coords.tolist()]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    if missing:
+        # Points outside the bounds of all wards need not be queried
+        in_bounds = in_ward_bounds(coords[missing, 0], coords[missing, 1])
+        for i in np.asarray(missing)[~in_bounds].tolist():
+            cache[keys[i]] = (None, None)
+        missing = np.asarray(missing)[in_bounds].tolist()
+
+    if missing:
+        ward_shapes, ward_tree, _ = _ward_index()
+        geometries, ward_ids, ward_names, ward_edges, edge_offsets = ward_shapes
+        # NOTE: The ward shapes are in (lng, lat).
+        lats, lngs = coords[missing, 0], coords[missing, 1]
+        points = shapely.points(lngs, lats)
+        # The tree returns the wards whose bounding box contains a point
+        point_idx, ward_idx = ward_tree.query(points)
+        xs, ys = lngs[point_idx], lats[point_idx]
+        if contains_xy is not None:
+            # The ray-casting check avoids calling GEOS for most candidates,
+            # and only the uncertain ones are checked using shapely.
+            inside, uncertain = contains_xy(
+                ward_edges, edge_offsets, ward_idx, xs, ys
+            )
+            inside[uncertain] = shapely.contains_xy(
+                geometries[ward_idx[uncertain]], xs[uncertain], ys[uncertain]
+            )
+        else:
+            inside = shapely.contains_xy(geometries[ward_idx], xs, ys)
+        point_idx, ward_idx = point_idx[inside], ward_idx[inside]
+        # Pick the first ward found for each point
+        point_idx, first = np.unique(point_idx, return_index=True)
+        found = dict(zip(point_idx.tolist(), ward_idx[first].tolist()))
+        for i, key in enumerate(keys[j] for j in missing):
+            if i in found:
+                idx = found[i]
+                cache[key] = (int(ward_ids[idx]), ward_names[idx])
+            else:
+                cache[key] = (None, None)
+
+    return [cache[key] for key in keys]
 
 
 def route_to_wards(route):
     """List of wards for the bus-stops in a route.
 
-    The function de-duplicates wards, and only returns unique wards.
+    The route can either be a row of the routes data, or the list of its
+    (parsed) bus-stops. The function de-duplicates wards, and only returns
+    unique wards.
     """
-    try:
-        bus_stops = json.loads(route.map_json_content)
-    except TypeError:
+    bus_stops = route if isinstance(route, list) else route.bus_stops
+    if not bus_stops:
         return []
-    wards = [get_ward(bus_stop["latlons"]) for bus_stop in bus_stops]
-    return sorted(set(wards), key=lambda x: wards.index(x))
+    wards = get_wards_for_points([bus_stop["latlons"] for bus_stop in bus_stops])
+    return list(dict.fromkeys(wards))
 
 
 def read_uber_travel_time():
-    global UBER_TRAVEL_TIMES
+    global UBER_TRAVEL_TIMES, UBER_MEAN_TIMES
     if not UBER_TRAVEL_TIMES:
         path = join(DATA, "uber-travel-time-data.json")
-        with open(path) as f:
-            UBER_TRAVEL_TIMES = json.load(f)
+        with open(path, "rb") as f:
+            UBER_TRAVEL_TIMES = json_loads(f.read())
+        # Precompute the mean travel times across days, for each ward pair
+        UBER_MEAN_TIMES = {
+            key: float(
+                np.mean(
+                    [day["meanTravelTimeSec"] for day in data[0]["daily"].values()]
+                )
+            )
+            for key, data in UBER_TRAVEL_TIMES.items()
+            if data and data[0]["daily"]
+        }
 
     return UBER_TRAVEL_TIMES
 
 
 def mean_time(src, dst):
-    key = "{}-{}".format(src, dst)
-    data = UBER_TRAVEL_TIMES.get(key)
-    if not data:
-        return None
-    data = [day["meanTravelTimeSec"] for day in data[0]["daily"].values()]
-    return sum(data) / len(data)
+    return UBER_MEAN_TIMES.get(f"{src}-{dst}")
 
 
 def mean_route_time(wards):
     pairs = zip(wards[:-1], wards[1:])
-    route_time = 0
-    for (src_id, _), (dst_id, _) in pairs:
-        time = mean_time(src_id, dst_id)
-        if time is not None:
-            route_time += time
-    return route_time
+    return sum(
+        mean_time(src_id, dst_id) or 0 for (src_id, _), (dst_id, _) in pairs
+    )
 
 
 def estimate_travel_time(route):